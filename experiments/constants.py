@@ -29,6 +29,8 @@ Amazon_FAISS_INDEX_PATH = None
 MNLI_ANLI_FAISS_INDEX_PATH = None
 
 MNLI_TRAIN_INPUT_COLLECTIONS_PATH = None
+# On-disk cache of `misc_utils.precompute_BERT_CLS_features`
+CLS_FEATURES_CACHE_DIR = None
 
 HANS_DATA_DIR = None
 # changed this:
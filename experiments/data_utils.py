@@ -4,19 +4,23 @@
 # For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 
 import os
+import csv
 import time
 import torch
 import logging
+import zipfile
+import numpy as np
 import pandas as pd
 from tqdm import trange
-from typing import Optional, Union, List, Dict
+from typing import Optional, Union, List, Dict, Iterable, Iterator
 
 from transformers import (
     GlueDataset,
     GlueDataTrainingArguments,
     PreTrainedTokenizer,
-    glue_convert_examples_to_features,
+    PreTrainedTokenizerFast,
     InputExample,
+    InputFeatures,
     DataProcessor,
     # Used in label-flipping hacks
     RobertaTokenizer,
@@ -40,11 +44,281 @@ except ModuleNotFoundError:
 
 logger = logging.getLogger(__name__)
 
+TORCH_VERSION = tuple(
+    int(v) for v in torch.__version__.split("+")[0].split(".")[:2])
+
+
+class InputExampleSlim(object):
+    """Drop-in replacement of `InputExample` using `__slots__`.
+
+    `InputExample` is a dataclass with a per-instance `__dict__`, which adds
+    up when creating hundreds of thousands of them. Only the four attributes
+    read during tokenization are kept.
+    """
+
+    __slots__ = ("guid", "text_a", "text_b", "label")
+
+    def __init__(
+        self,
+        guid: str,
+        text_a: str,
+        text_b: Optional[str] = None,
+        label: Optional[str] = None,
+    ):
+        self.guid = guid
+        self.text_a = text_a
+        self.text_b = text_b
+        self.label = label
+
+    def __repr__(self) -> str:
+        return (
+            f"{self.__class__.__name__}(guid={self.guid!r}, "
+            f"text_a={self.text_a!r}, text_b={self.text_b!r}, "
+            f"label={self.label!r})"
+        )
+
+
+# Stored in place of the label for examples without one (e.g., test sets)
+MISSING_LABEL_ID = -1
+
+
+class ArrayFeatures(object):
+    """Features stored as contiguous arrays instead of a list of `InputFeatures`.
+
+    Each field is saved as its own `.npy` file next to the cache prefix, so the
+    cache can be memory-mapped on load rather than unpickled example by example.
+    Indexing returns `InputFeatures` whose fields are `np.int64` copies of
+    the rows, which `default_data_collator` consumes as before.
+    """
+
+    FIELDS = ["input_ids", "attention_mask", "token_type_ids", "labels"]
+    # Token ids need more than 16 bits for large vocabularies, while
+    # `attention_mask` and `token_type_ids` only take values in {0, 1}.
+    # Rows are widened to `np.int64` when indexed, so collators that keep
+    # the input dtype still produce `torch.long` tensors.
+    INPUT_IDS_DTYPE = np.int32
+    MASK_DTYPE = np.uint8
+
+    def __init__(
+        self,
+        input_ids: np.ndarray,
+        attention_mask: np.ndarray,
+        token_type_ids: Optional[np.ndarray],
+        labels: np.ndarray,
+    ):
+        if not (
+            input_ids.shape == attention_mask.shape
+            and input_ids.shape[0] == labels.shape[0]
+        ):
+            raise ValueError("Feature arrays have mismatched shapes")
+        if token_type_ids is not None and token_type_ids.shape != input_ids.shape:
+            raise ValueError("Feature arrays have mismatched shapes")
+
+        self.input_ids = input_ids
+        self.attention_mask = attention_mask
+        self.token_type_ids = token_type_ids
+        self.labels = labels
+
+    @classmethod
+    def empty(cls) -> "ArrayFeatures":
+        return cls(
+            input_ids=np.zeros([0, 0], dtype=cls.INPUT_IDS_DTYPE),
+            attention_mask=np.zeros([0, 0], dtype=cls.MASK_DTYPE),
+            token_type_ids=None,
+            labels=np.zeros([0], dtype=np.int64),
+        )
+
+    @classmethod
+    def from_features(cls, features: List[InputFeatures]) -> "ArrayFeatures":
+        if len(features) == 0:
+            return cls.empty()
+
+        if features[0].token_type_ids is None:
+            token_type_ids = None
+        else:
+            token_type_ids = np.array(
+                [f.token_type_ids for f in features], dtype=cls.MASK_DTYPE
+            )
+
+        return cls(
+            input_ids=np.array(
+                [f.input_ids for f in features], dtype=cls.INPUT_IDS_DTYPE),
+            attention_mask=np.array(
+                [f.attention_mask for f in features], dtype=cls.MASK_DTYPE
+            ),
+            token_type_ids=token_type_ids,
+            labels=np.array(
+                [
+                    MISSING_LABEL_ID if f.label is None else f.label
+                    for f in features
+                ],
+                dtype=np.int64,
+            ),
+        )
+
+    @staticmethod
+    def _field_file_name(prefix: str, field: str) -> str:
+        return f"{prefix}.{field}.npy"
+
+    @classmethod
+    def exists(cls, prefix: str) -> bool:
+        # `token_type_ids` are not produced by every tokenizer
+        return all(
+            os.path.exists(cls._field_file_name(prefix, field))
+            for field in cls.FIELDS
+            if field != "token_type_ids"
+        )
+
+    @classmethod
+    def load(cls, prefix: str) -> "ArrayFeatures":
+        arrays = {}
+        for field in cls.FIELDS:
+            file_name = cls._field_file_name(prefix, field)
+            if field == "token_type_ids" and not os.path.exists(file_name):
+                arrays[field] = None
+            else:
+                arrays[field] = np.load(file_name, mmap_mode="r")
+        return cls(**arrays)
+
+    def save(self, prefix: str) -> None:
+        # Each field is written under a temporary name and then moved into
+        # place, and `labels` are written last, so a partially written cache
+        # is not picked up by `exists`
+        for field in self.FIELDS:
+            array = getattr(self, field)
+            if array is None:
+                continue
+
+            file_name = self._field_file_name(prefix, field)
+            tmp_file_name = f"{file_name}.tmp"
+            with open(tmp_file_name, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_file_name, file_name)
+
+    def __len__(self) -> int:
+        return self.input_ids.shape[0]
+
+    def __getitem__(self, i: int) -> InputFeatures:
+        label = int(self.labels[i])
+        return InputFeatures(
+            input_ids=self.input_ids[i].astype(np.int64),
+            attention_mask=self.attention_mask[i].astype(np.int64),
+            token_type_ids=(
+                None if self.token_type_ids is None
+                else self.token_type_ids[i].astype(np.int64)
+            ),
+            label=None if label == MISSING_LABEL_ID else label,
+        )
+
+
+def convert_examples_to_array_features(
+    examples: List[Union[InputExample, InputExampleSlim]],
+    tokenizer: PreTrainedTokenizer,
+    max_length: int,
+    label_list: List[str],
+) -> ArrayFeatures:
+    """Tokenizes all examples with a single batched tokenizer call.
+
+    Equivalent to `glue_convert_examples_to_features` for classification
+    tasks, but writes the encodings straight into arrays instead of building
+    one `InputFeatures` per example. With a `PreTrainedTokenizerFast`, the
+    batch is tokenized in parallel across CPU cores.
+    """
+    if len(examples) == 0:
+        return ArrayFeatures.empty()
+
+    if isinstance(tokenizer, PreTrainedTokenizerFast):
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+    else:
+        logger.info(
+            f"{tokenizer.__class__.__name__} is not a fast tokenizer, "
+            f"examples will be tokenized sequentially"
+        )
+
+    if examples[0].text_b is None:
+        texts_b = None
+    else:
+        texts_b = [example.text_b for example in examples]
+
+    encodings = tokenizer(
+        [example.text_a for example in examples],
+        text_pair=texts_b,
+        max_length=max_length,
+        padding="max_length",
+        truncation=True,
+        return_tensors="np",
+    )
+
+    label_map = {label: i for i, label in enumerate(label_list)}
+    labels = np.array(
+        [
+            MISSING_LABEL_ID if example.label is None
+            else label_map[example.label]
+            for example in examples
+        ],
+        dtype=np.int64,
+    )
+
+    token_type_ids = encodings.get("token_type_ids")
+    if token_type_ids is not None:
+        token_type_ids = token_type_ids.astype(ArrayFeatures.MASK_DTYPE)
+
+    return ArrayFeatures(
+        input_ids=encodings["input_ids"].astype(ArrayFeatures.INPUT_IDS_DTYPE),
+        attention_mask=encodings["attention_mask"].astype(
+            ArrayFeatures.MASK_DTYPE),
+        token_type_ids=token_type_ids,
+        labels=labels,
+    )
+
+
+def load_torch_features_cache(file_name: str) -> List[InputFeatures]:
+    """Loads a `List[InputFeatures]` saved with `torch.save`.
+
+    On PyTorch >= 2.1 zipfile-format files are memory-mapped instead of read
+    into memory first. Files in the legacy format (the default of `torch.save`
+    before PyTorch 1.6) cannot be memory-mapped and are loaded as usual.
+    `weights_only` has to be off since the list holds dataclasses.
+    """
+    if TORCH_VERSION >= (2, 1) and zipfile.is_zipfile(file_name):
+        return torch.load(
+            file_name, map_location="cpu", mmap=True, weights_only=False)
+    if TORCH_VERSION >= (1, 13):
+        return torch.load(file_name, map_location="cpu", weights_only=False)
+    return torch.load(file_name, map_location="cpu")
+
+
+def get_label_list(
+    processor: DataProcessor,
+    task_name: str,
+    tokenizer: PreTrainedTokenizer,
+) -> List[str]:
+    label_list = processor.get_labels()
+    if task_name in [
+        "mnli",
+        "mnli-mm",
+        "mnli-2",
+        "mnli-2-mm",
+        "hans",
+    ] and tokenizer.__class__ in (
+        RobertaTokenizer,
+        RobertaTokenizerFast,
+        XLMRobertaTokenizer,
+        BartTokenizer,
+        BartTokenizerFast,
+    ):
+        # HACK(label indices are swapped in RoBERTa pretrained model)
+        label_list[1], label_list[2] = label_list[2], label_list[1]
+    return label_list
+
 
 class CustomGlueDataset(GlueDataset):
     """Customized GlueData with changes:
 
     1. Changed the `glue_processors` and `glue_output_modes` to customized ones.
+    2. Features are cached as memory-mapped arrays (see `ArrayFeatures`).
+    3. `processor` and `label_list` (from `get_label_list`) can be passed in
+       to share them across the splits of the same task.
     """
 
     def __init__(
@@ -54,10 +328,16 @@ class CustomGlueDataset(GlueDataset):
         limit_length: Optional[int] = None,
         mode: Union[str, Split] = Split.train,
         cache_dir: Optional[str] = None,
+        processor: Optional[DataProcessor] = None,
+        label_list: Optional[List[str]] = None,
     ):
         self.args = args
-        self.processor = glue_processors[args.task_name]()
+        if processor is None:
+            processor = glue_processors[args.task_name]()
+        self.processor = processor
         self.output_mode = glue_output_modes[args.task_name]
+        if self.output_mode != "classification":
+            raise ValueError(f"Unsupported output mode {self.output_mode}")
         if isinstance(mode, str):
             try:
                 mode = Split[mode]
@@ -73,22 +353,9 @@ class CustomGlueDataset(GlueDataset):
                 args.task_name,
             ),
         )
-        label_list = self.processor.get_labels()
-        if args.task_name in [
-            "mnli",
-            "mnli-mm",
-            "mnli-2",
-            "mnli-2-mm",
-            "hans",
-        ] and tokenizer.__class__ in (
-            RobertaTokenizer,
-            RobertaTokenizerFast,
-            XLMRobertaTokenizer,
-            BartTokenizer,
-            BartTokenizerFast,
-        ):
-            # HACK(label indices are swapped in RoBERTa pretrained model)
-            label_list[1], label_list[2] = label_list[2], label_list[1]
+        if label_list is None:
+            label_list = get_label_list(
+                self.processor, task_name=args.task_name, tokenizer=tokenizer)
         self.label_list = label_list
 
         # Make sure only the first process in distributed training processes the dataset,
@@ -96,13 +363,23 @@ class CustomGlueDataset(GlueDataset):
         # lock_path = cached_features_file + ".lock"
         # with FileLock(lock_path):
 
-        if os.path.exists(cached_features_file) and not args.overwrite_cache:
+        if ArrayFeatures.exists(cached_features_file) and not args.overwrite_cache:
             start = time.time()
-            self.features = torch.load(cached_features_file)
+            self.features = ArrayFeatures.load(cached_features_file)
             logger.info(
                 f"Loading features from cached file {cached_features_file} [took %.3f s]",
                 time.time() - start,
             )
+        elif os.path.exists(cached_features_file) and not args.overwrite_cache:
+            # Caches written by `torch.save` before `ArrayFeatures`
+            start = time.time()
+            self.features = ArrayFeatures.from_features(
+                load_torch_features_cache(cached_features_file))
+            self.features.save(cached_features_file)
+            logger.info(
+                f"Converted features from cached file {cached_features_file} [took %.3f s]",
+                time.time() - start,
+            )
         else:
             logger.info(
                 f"Creating features from dataset file at {args.data_dir}"
@@ -116,16 +393,14 @@ class CustomGlueDataset(GlueDataset):
                 examples = self.processor.get_train_examples(args.data_dir)
             if limit_length is not None:
                 examples = examples[:limit_length]
-            self.features = glue_convert_examples_to_features(
+            self.features = convert_examples_to_array_features(
                 examples,
                 tokenizer,
                 max_length=args.max_seq_length,
                 label_list=label_list,
-                output_mode=self.output_mode,
             )
             start = time.time()
-            torch.save(self.features, cached_features_file)
-            # ^ This seems to take a lot of time so I want to investigate why and how we can improve.
+            self.features.save(cached_features_file)
             logger.info(
                 "Saving features into cached file %s [took %.3f s]",
                 cached_features_file,
@@ -133,55 +408,113 @@ class CustomGlueDataset(GlueDataset):
             )
 
 
-class TwoLabelMnliProcessor(MnliProcessor):
-    def get_labels(self) -> List[str]:
-        """See base class."""
-        return ["non_entailment", "entailment"]
+class DataFrameTSVMixin(object):
+    """Streams TSV files column-wise as chunks of `pd.DataFrame` of strings.
+
+    Replaces `DataProcessor._read_tsv`, which reads the whole file into
+    `List[List[str]]`, so that `_create_examples_from_lines` can work on whole
+    columns at a time while only one chunk of raw lines is held in memory.
+    The header row is consumed by `pd.read_csv`.
+    """
+
+    tsv_chunk_size = 100000
+
+    @classmethod
+    def _read_tsv(
+        cls, input_file: str, quotechar: Optional[str] = None
+    ) -> Iterator[pd.DataFrame]:
+        if quotechar is None:
+            quoting_kwargs = {"quoting": csv.QUOTE_NONE}
+        else:
+            quoting_kwargs = {"quotechar": quotechar}
+
+        reader = pd.read_csv(
+            input_file,
+            sep="\t",
+            dtype=str,
+            # Keep strings like "null" or "NA" as they are
+            na_filter=False,
+            encoding="utf-8-sig",
+            engine="c",
+            chunksize=cls.tsv_chunk_size,
+            **quoting_kwargs,
+        )
+        try:
+            yield from reader
+        finally:
+            reader.close()
 
     def _create_examples(
-        self, lines: List[List[str]], set_type: str
-    ) -> List[InputExample]:
+        self, chunks: Iterable[pd.DataFrame], set_type: str
+    ) -> List[InputExampleSlim]:
         """Creates examples for the training, dev and test sets."""
         examples = []
-        for (i, line) in enumerate(lines):
-            if i == 0:
-                continue
-            guid = "%s-%s" % (set_type, line[0])
-            text_a = line[8]
-            text_b = line[9]
-            label = (
-                None
-                if set_type.startswith("test")
-                else self._preprocess_label(line[-1])
-            )
-            examples.append(
-                InputExample(
-                    guid=guid, text_a=text_a, text_b=text_b, label=label
-                )
-            )
+        # Line indices start from 1 since the header is line 0
+        line_index = 1
+        for lines in chunks:
+            examples.extend(self._create_examples_from_lines(
+                lines, set_type=set_type, line_index=line_index))
+            line_index += len(lines)
         return examples
 
-    def _preprocess_label(self, label: str) -> str:
-        if label not in ["contradiction", "entailment", "neutral"]:
-            raise ValueError(f"Label {label} not recognized.")
+    def _create_examples_from_lines(
+        self, lines: pd.DataFrame, set_type: str, line_index: int
+    ) -> List[InputExampleSlim]:
+        """Creates examples from a chunk of lines starting at `line_index`."""
+        raise NotImplementedError
 
-        if label in ["contradiction", "neutral"]:
-            return "non_entailment"
+
+def map_labels(labels: pd.Series, label_map: Dict[str, str]) -> List[str]:
+    unrecognized = ~labels.isin(label_map.keys())
+    if unrecognized.any():
+        raise ValueError(
+            f"Label {labels[unrecognized].iloc[0]} not recognized.")
+
+    return labels.map(label_map).tolist()
+
+
+class TwoLabelMnliProcessor(DataFrameTSVMixin, MnliProcessor):
+    label_map = {
+        "contradiction": "non_entailment",
+        "neutral": "non_entailment",
+        "entailment": "entailment",
+    }
+
+    def get_labels(self) -> List[str]:
+        """See base class."""
+        return ["non_entailment", "entailment"]
+
+    def _create_examples_from_lines(
+        self, lines: pd.DataFrame, set_type: str, line_index: int
+    ) -> List[InputExampleSlim]:
+        """See `DataFrameTSVMixin`."""
+        guids = (set_type + "-" + lines.iloc[:, 0]).tolist()
+        texts_a = lines.iloc[:, 8].tolist()
+        texts_b = lines.iloc[:, 9].tolist()
+        if set_type.startswith("test"):
+            labels = [None] * len(lines)
         else:
-            return "entailment"
+            labels = map_labels(lines.iloc[:, -1], self.label_map)
+
+        return [
+            InputExampleSlim(
+                guid=guid, text_a=text_a, text_b=text_b, label=label)
+            for guid, text_a, text_b, label in zip(
+                guids, texts_a, texts_b, labels)
+        ]
 
 
 class TwoLabelMnliMismatchedProcessor(TwoLabelMnliProcessor):
     """Processor for the MultiNLI Mismatched data set (GLUE version)."""
 
-    def get_dev_examples(self, data_dir: str) -> List[InputExample]:
+    def get_dev_examples(self, data_dir: str) -> List[InputExampleSlim]:
         """See base class."""
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "dev_mismatched.tsv")),
             "dev_mismatched",
         )
 
-    def get_test_examples(self, data_dir: str) -> List[InputExample]:
+    def get_test_examples(self, data_dir: str) -> List[InputExampleSlim]:
         """See base class."""
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "test_mismatched.tsv")),
@@ -189,17 +522,22 @@ class TwoLabelMnliMismatchedProcessor(TwoLabelMnliProcessor):
         )
 
 
-class HansProcessor(DataProcessor):
+class HansProcessor(DataFrameTSVMixin, DataProcessor):
     """Processor for the HANS data set."""
 
-    def get_train_examples(self, data_dir: str) -> List[InputExample]:
+    label_map = {
+        "non-entailment": "non_entailment",
+        "entailment": "entailment",
+    }
+
+    def get_train_examples(self, data_dir: str) -> List[InputExampleSlim]:
         """See base class."""
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "heuristics_train_set.txt")),
             "train",
         )
 
-    def get_dev_examples(self, data_dir: str) -> List[InputExample]:
+    def get_dev_examples(self, data_dir: str) -> List[InputExampleSlim]:
         """See base class."""
         return self._create_examples(
             self._read_tsv(
@@ -212,36 +550,26 @@ class HansProcessor(DataProcessor):
         """See base class."""
         return ["non_entailment", "entailment"]
 
-    def _create_examples(
-        self, lines: List[List[str]], set_type: str
-    ) -> List[InputExample]:
-        """Creates examples for the training and dev sets."""
-        examples = []
-        for (i, line) in enumerate(lines):
-            if i == 0:
-                continue
-            guid = "%s-%s" % (set_type, i)
-            text_a = line[5]
-            text_b = line[6]
-            label = self._preprocess_label(line[0])
-            examples.append(
-                InputExample(
-                    guid=guid, text_a=text_a, text_b=text_b, label=label
-                )
-            )
-        return examples
-
-    def _preprocess_label(self, label: str) -> str:
-        if label not in ["non-entailment", "entailment"]:
-            raise ValueError(f"Label {label} not recognized.")
-
-        if label in ["non-entailment"]:
-            return "non_entailment"
-        else:
-            return "entailment"
-
-
-class WILDSAmazonProcessor(DataProcessor):
+    def _create_examples_from_lines(
+        self, lines: pd.DataFrame, set_type: str, line_index: int
+    ) -> List[InputExampleSlim]:
+        """See `DataFrameTSVMixin`."""
+        guids = [
+            f"{set_type}-{i}"
+            for i in range(line_index, line_index + len(lines))]
+        texts_a = lines.iloc[:, 5].tolist()
+        texts_b = lines.iloc[:, 6].tolist()
+        labels = map_labels(lines.iloc[:, 0], self.label_map)
+
+        return [
+            InputExampleSlim(
+                guid=guid, text_a=text_a, text_b=text_b, label=label)
+            for guid, text_a, text_b, label in zip(
+                guids, texts_a, texts_b, labels)
+        ]
+
+
+class WILDSAmazonProcessor(DataFrameTSVMixin, DataProcessor):
     """Processor for the Amazon data set (WILDS version)."""
 
     def get_train_examples(self, data_dir):
@@ -278,41 +606,41 @@ class WILDSAmazonProcessor(DataProcessor):
         """See base class."""
         return ["0", "1", "2", "3", "4"]
 
-    def _create_examples(self, lines, set_type):
-        """Creates examples for the training, dev and test sets."""
-        examples = []
-        for (i, line) in enumerate(lines):
-            if i == 0:
-                continue
-            guid = "%s-%s" % (set_type, i)
-            text_a = line[0]
-            label = line[1]
-            examples.append(
-                InputExample(
-                    guid=guid, text_a=text_a, text_b=None, label=label
-                )
-            )
-        return examples
+    def _create_examples_from_lines(self, lines, set_type, line_index):
+        """See `DataFrameTSVMixin`."""
+        guids = [
+            f"{set_type}-{i}"
+            for i in range(line_index, line_index + len(lines))]
+        texts_a = lines.iloc[:, 0].tolist()
+        labels = lines.iloc[:, 1].tolist()
 
+        return [
+            InputExampleSlim(
+                guid=guid, text_a=text_a, text_b=None, label=label)
+            for guid, text_a, label in zip(guids, texts_a, labels)
+        ]
 
-class ANLIProcessor(DataProcessor):
+
+class ANLIProcessor(DataFrameTSVMixin, DataProcessor):
     """Processor for the HANS data set."""
 
-    def get_train_examples(self, data_dir: str) -> List[InputExample]:
+    label_map = {"e": "entailment", "n": "neutral", "c": "contradiction"}
+
+    def get_train_examples(self, data_dir: str) -> List[InputExampleSlim]:
         """See base class."""
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "train.tsv"), quotechar='"'),
             "train",
         )
 
-    def get_dev_examples(self, data_dir: str) -> List[InputExample]:
+    def get_dev_examples(self, data_dir: str) -> List[InputExampleSlim]:
         """See base class."""
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "valid.tsv"), quotechar='"'),
             "dev",
         )
 
-    def get_test_examples(self, data_dir: str) -> List[InputExample]:
+    def get_test_examples(self, data_dir: str) -> List[InputExampleSlim]:
         """See base class."""
         return self._create_examples(
             self._read_tsv(os.path.join(data_dir, "test.tsv"), quotechar='"'),
@@ -323,31 +651,23 @@ class ANLIProcessor(DataProcessor):
         """See base class."""
         return ["contradiction", "entailment", "neutral"]
 
-    def _create_examples(
-        self, lines: List[List[str]], set_type: str
-    ) -> List[InputExample]:
-        """Creates examples for the training and dev sets."""
-        examples = []
-        for (i, line) in enumerate(lines):
-            if i == 0:
-                continue
-            guid = "%s-%s" % (set_type, i)
-            text_a = line[1]
-            text_b = line[2]
-            label = self._preprocess_label(line[3])
-            examples.append(
-                InputExample(
-                    guid=guid, text_a=text_a, text_b=text_b, label=label
-                )
-            )
-        return examples
-
-    def _preprocess_label(self, label: str) -> str:
-        label_map = {"e": "entailment", "n": "neutral", "c": "contradiction"}
-        if label not in label_map.keys():
-            raise ValueError(f"Label {label} not recognized.")
-
-        return label_map[label]
+    def _create_examples_from_lines(
+        self, lines: pd.DataFrame, set_type: str, line_index: int
+    ) -> List[InputExampleSlim]:
+        """See `DataFrameTSVMixin`."""
+        guids = [
+            f"{set_type}-{i}"
+            for i in range(line_index, line_index + len(lines))]
+        texts_a = lines.iloc[:, 1].tolist()
+        texts_b = lines.iloc[:, 2].tolist()
+        labels = map_labels(lines.iloc[:, 3], self.label_map)
+
+        return [
+            InputExampleSlim(
+                guid=guid, text_a=text_a, text_b=text_b, label=label)
+            for guid, text_a, text_b, label in zip(
+                guids, texts_a, texts_b, labels)
+        ]
 
 
 def glue_compute_metrics(
@@ -360,22 +680,28 @@ def glue_compute_metrics(
     return {"acc": simple_accuracy(preds, labels)}
 
 
-def write_amazon_dataset_to_disk(base_dir: str) -> None:
+def write_amazon_dataset_to_disk(
+    base_dir: str, chunk_size: int = 100000
+) -> None:
     dataset = AmazonDataset(download=False)
     for split in dataset.split_dict.keys():
         datasubset = dataset.get_subset(split)
         file_name = os.path.join(base_dir, f"amazon.{split}.tsv")
 
-        examples = []
-        for index in trange(len(datasubset)):
-            examples.append(
-                {
-                    "sentence": datasubset[index][0],
-                    "label": datasubset[index][1].item(),
-                }
-            )
-
-        pd.DataFrame(examples).to_csv(file_name, sep="\t", index=False)
+        # Labels of the whole split at once, instead
+        # of one `.item()` call per example
+        labels = datasubset.y_array.cpu().numpy()
+        for start_index in trange(0, len(datasubset), chunk_size):
+            indices = datasubset.indices[start_index: start_index + chunk_size]
+            pd.DataFrame({
+                "sentence": [dataset.get_input(index) for index in indices],
+                "label": labels[start_index: start_index + chunk_size],
+            }).to_csv(
+                file_name,
+                sep="\t",
+                index=False,
+                mode="w" if start_index == 0 else "a",
+                header=start_index == 0)
 
         print(f"Wrote {file_name} to disk")
 
@@ -460,20 +460,19 @@ def create_FAISS_index(
         raise ValueError
 
     if trained_on_task_name == "mnli":
-        tokenizer, model = misc_utils.create_tokenizer_and_model(
-            constants.MNLI_MODEL_PATH)
+        model_name_or_path = constants.MNLI_MODEL_PATH
 
     if trained_on_task_name == "mnli-2":
-        tokenizer, model = misc_utils.create_tokenizer_and_model(
-            constants.MNLI2_MODEL_PATH)
+        model_name_or_path = constants.MNLI2_MODEL_PATH
 
     if trained_on_task_name == "hans":
-        tokenizer, model = misc_utils.create_tokenizer_and_model(
-            constants.HANS_MODEL_PATH)
+        model_name_or_path = constants.HANS_MODEL_PATH
 
     if trained_on_task_name == "amazon":
-        tokenizer, model = misc_utils.create_tokenizer_and_model(
-            constants.Amazon_MODEL_PATH)
+        model_name_or_path = constants.Amazon_MODEL_PATH
+
+    tokenizer, model = misc_utils.create_tokenizer_and_model(
+        model_name_or_path)
 
     train_dataset, _ = misc_utils.create_datasets(
         task_name=train_task_name,
@@ -482,17 +481,18 @@ def create_FAISS_index(
     faiss_index = faiss_utils.FAISSIndex(768, "Flat")
 
     model.cuda()
-    device = model.device
-    train_batch_data_loader = misc_utils.get_dataloader(
+    features = misc_utils.precompute_BERT_CLS_features(
+        model=model,
         dataset=train_dataset,
-        batch_size=128,
-        random=False)
-
-    for inputs in tqdm(train_batch_data_loader):
-        for k, v in inputs.items():
-            inputs[k] = v.to(device)
-        features = misc_utils.compute_BERT_CLS_feature(model, **inputs)
-        features = features.cpu().detach().numpy()
-        faiss_index.add(features)
+        file_name=misc_utils.get_CLS_features_file_name(
+            model_name_or_path=model_name_or_path,
+            task_name=train_task_name,
+            mode="train"),
+        batch_size=128)
+
+    # FAISS only takes `float32` inputs, upcast in chunks to bound memory
+    for start_index in tqdm(range(0, features.shape[0], 10000)):
+        faiss_index.add(np.asarray(
+            features[start_index: start_index + 10000], dtype=np.float32))
 
     return faiss_index
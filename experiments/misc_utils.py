@@ -5,7 +5,9 @@
 
 import os
 import torch
+import hashlib
 import numpy as np
+from operator import itemgetter
 
 # from tqdm import tqdm
 from torch.utils.data.dataloader import DataLoader
@@ -24,11 +26,16 @@ from transformers import (
 
 from influence_utils import glue_utils
 from experiments import constants
-from experiments.data_utils import CustomGlueDataset
+from experiments import data_utils
+from experiments.data_utils import CustomGlueDataset, TORCH_VERSION
+
+# For `get_dataloader` callers that opt in to worker processes, i.e., bulk
+# loaders over the CPU-side arrays of `CustomGlueDataset`
+NUM_DATALOADER_WORKERS = (os.cpu_count() or 0) // 2
 
 
 def sort_dict_keys_by_vals(d: Dict[int, float]) -> List[int]:
-    sorted_items = sorted(list(d.items()), key=lambda pair: pair[1])
+    sorted_items = sorted(list(d.items()), key=itemgetter(1))
     return [pair[0] for pair in sorted_items]
 
 
@@ -36,43 +43,116 @@ def sort_dict_keys_by_vals_with_conditions(
     d: Dict[int, float], condition_func: Callable[[Tuple[int, float]], bool]
 ) -> List[int]:
 
-    sorted_items = sorted(list(d.items()), key=lambda pair: pair[1])
+    sorted_items = sorted(list(d.items()), key=itemgetter(1))
     return [pair[0] for pair in sorted_items if condition_func(pair)]
 
 
+def get_n_smallest_keys_by_vals(
+    keys: np.ndarray, vals: np.ndarray, n: int
+) -> List[int]:
+    """Partial selection, O(len(vals) + n log n) instead of a full sort."""
+    if n < vals.shape[0]:
+        selected = np.argpartition(vals, n)[:n]
+    else:
+        selected = np.arange(vals.shape[0])
+
+    selected = selected[np.argsort(vals[selected], kind="stable")]
+    return keys[selected].tolist()
+
+
 def get_helpful_harmful_indices_from_influences_dict(
     d: Dict[int, float],
     n: Optional[int] = None,
 ) -> Tuple[List[int], List[int]]:
 
-    helpful_indices = sort_dict_keys_by_vals_with_conditions(
-        d, condition_func=lambda k_v: k_v[1] < 0.0
-    )
-    harmful_indices = sort_dict_keys_by_vals_with_conditions(
-        d, condition_func=lambda k_v: k_v[1] > 0.0
-    )[::-1]
-
-    if n is not None:
-        if len(helpful_indices) < n:
-            raise ValueError(
-                f"`helpful_indices` have only "
-                f"{len(helpful_indices)} elememts "
-                f"whereas {n} is needed"
-            )
-
-        if len(harmful_indices) < n:
-            raise ValueError(
-                f"`harmful_indices` have only "
-                f"{len(harmful_indices)} elememts "
-                f"whereas {n} is needed"
-            )
-
-        helpful_indices = helpful_indices[:n]
-        harmful_indices = harmful_indices[:n]
+    if n is None:
+        helpful_indices = sort_dict_keys_by_vals_with_conditions(
+            d, condition_func=lambda k_v: k_v[1] < 0.0
+        )
+        harmful_indices = sort_dict_keys_by_vals_with_conditions(
+            d, condition_func=lambda k_v: k_v[1] > 0.0
+        )[::-1]
+        return helpful_indices, harmful_indices
+
+    keys = np.fromiter(d.keys(), dtype=np.int64, count=len(d))
+    vals = np.fromiter(d.values(), dtype=np.float64, count=len(d))
+    helpful_mask = vals < 0.0
+    harmful_mask = vals > 0.0
+
+    if helpful_mask.sum() < n:
+        raise ValueError(
+            f"`helpful_indices` have only "
+            f"{helpful_mask.sum()} elememts "
+            f"whereas {n} is needed"
+        )
+
+    if harmful_mask.sum() < n:
+        raise ValueError(
+            f"`harmful_indices` have only "
+            f"{harmful_mask.sum()} elememts "
+            f"whereas {n} is needed"
+        )
+
+    helpful_indices = get_n_smallest_keys_by_vals(
+        keys[helpful_mask], vals[helpful_mask], n=n)
+    # Most harmful ones have the largest values
+    harmful_indices = get_n_smallest_keys_by_vals(
+        keys[harmful_mask], -vals[harmful_mask], n=n)
 
     return helpful_indices, harmful_indices
 
 
+# Position of the [CLS] (or <s>) token. This used to be `-1`, which for
+# inputs padded to `max_seq_length` is almost always a padding token.
+CLS_TOKEN_INDEX = 0
+
+
+def _flatten_to_2d(tensor: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+    if tensor is None or tensor.dim() == 2:
+        return tensor
+    return tensor.reshape([-1, tensor.shape[-1]])
+
+
+# Encoder forward functions, tried in order based on the attribute
+# holding the encoder, with `model.model.encoder` (e.g., BART) as fallback
+_ENCODER_FORWARDS = {
+    "bert": lambda model, input_ids, attention_mask, token_type_ids: (
+        model.bert(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=_flatten_to_2d(token_type_ids))),
+    "distilbert": lambda model, input_ids, attention_mask, token_type_ids: (
+        model.distilbert(input_ids, attention_mask=attention_mask)),
+    "roberta": lambda model, input_ids, attention_mask, token_type_ids: (
+        model.roberta(input_ids, attention_mask=attention_mask)),
+    "deberta": lambda model, input_ids, attention_mask, token_type_ids: (
+        model.deberta(input_ids, attention_mask=attention_mask)),
+}
+
+
+def _fallback_encoder_forward(model, input_ids, attention_mask, token_type_ids):
+    return model.model.encoder(input_ids, attention_mask=attention_mask)
+
+
+_encoder_forwards_by_model_class: Dict[type, Callable] = {}
+
+
+def _get_encoder_forward(model) -> Callable:
+    """Resolves the encoder forward function once per model class, as
+    `compute_BERT_CLS_feature` is called once per example in some loops."""
+    model_class = type(model)
+    encoder_forward = _encoder_forwards_by_model_class.get(model_class)
+    if encoder_forward is None:
+        encoder_forward = _fallback_encoder_forward
+        for name, forward in _ENCODER_FORWARDS.items():
+            if hasattr(model, name):
+                encoder_forward = forward
+                break
+        _encoder_forwards_by_model_class[model_class] = encoder_forward
+
+    return encoder_forward
+
+
 def compute_BERT_CLS_feature(
     model,
     input_ids=None,
@@ -89,49 +169,105 @@ def compute_BERT_CLS_feature(
     """
     if model.training is True:
         raise ValueError
-    if hasattr(model, "bert"):
-        outputs = model.bert(
-            input_ids.reshape([-1, input_ids.shape[-1]]),
-            attention_mask=attention_mask.reshape(
-                [-1, attention_mask.shape[-1]]
-            ),
-            token_type_ids=token_type_ids.reshape(
-                [-1, token_type_ids.shape[-1]]
-            ),
-        )
-    elif hasattr(model, "distilbert"):
-        outputs = model.distilbert(
-            input_ids.reshape([-1, input_ids.shape[-1]]),
-            attention_mask=attention_mask.reshape(
-                [-1, attention_mask.shape[-1]]
-            ),
-        )
-    elif hasattr(model, "roberta"):
-        outputs = model.roberta(
-            input_ids.reshape([-1, input_ids.shape[-1]]),
-            attention_mask=attention_mask.reshape(
-                [-1, attention_mask.shape[-1]]
-            ),
-        )
-    elif hasattr(model, "deberta"):
-        outputs = model.deberta(
-            input_ids.reshape([-1, input_ids.shape[-1]]),
-            attention_mask=attention_mask.reshape(
-                [-1, attention_mask.shape[-1]]
-            ),
-        )
-    else:
-        outputs = model.model.encoder(
-            input_ids.reshape([-1, input_ids.shape[-1]]),
-            attention_mask=attention_mask.reshape(
-                [-1, attention_mask.shape[-1]]
-            ),
-        )
-    output = outputs[0][:, -1, :]
+
+    encoder_forward = _get_encoder_forward(model)
+    outputs = encoder_forward(
+        model,
+        input_ids=_flatten_to_2d(input_ids),
+        attention_mask=_flatten_to_2d(attention_mask),
+        token_type_ids=token_type_ids,
+    )
+    output = outputs[0][:, CLS_TOKEN_INDEX, :]
     return output
     # return model.dropout(output)
 
 
+# Precomputed features are only used for similarity search and dot-products,
+# which do not need the full precision. Upcast with `.float()` if needed.
+CLS_FEATURES_CACHE_DTYPE = np.float16
+
+
+def get_CLS_features_file_name(
+    model_name_or_path: str,
+    task_name: str,
+    mode: str,
+    cache_dir: Optional[str] = None,
+) -> Optional[str]:
+    """File name for `precompute_BERT_CLS_features`, or `None` when there is
+    no `cache_dir` (defaults to `constants.CLS_FEATURES_CACHE_DIR`). The model
+    is identified explicitly by its path, since fine-tuned checkpoints of the
+    same class are otherwise indistinguishable."""
+    if cache_dir is None:
+        cache_dir = constants.CLS_FEATURES_CACHE_DIR
+    if cache_dir is None:
+        return None
+
+    model_hash = hashlib.sha1(
+        f"{model_name_or_path}:{CLS_TOKEN_INDEX}".encode()).hexdigest()
+    return os.path.join(
+        cache_dir, f"CLS_features.{task_name}.{mode}.{model_hash}.npy")
+
+
+def precompute_BERT_CLS_features(
+    model,
+    dataset: CustomGlueDataset,
+    file_name: Optional[str] = None,
+    batch_size: int = 128,
+) -> np.ndarray:
+    """Computes the features of the whole dataset once into a
+    `(num_examples, hidden_size)` array of `CLS_FEATURES_CACHE_DTYPE`, so that
+    later lookups are indexing. When `file_name` is given, the array is
+    memory-mapped from that file and reused across runs, so the file name
+    must identify both the model and the dataset."""
+    if file_name is not None and os.path.exists(file_name):
+        return np.load(file_name, mmap_mode="r")
+
+    if len(dataset) == 0:
+        return np.zeros(
+            [0, model.config.hidden_size], dtype=CLS_FEATURES_CACHE_DTYPE)
+
+    data_loader = get_dataloader(
+        dataset=dataset,
+        batch_size=batch_size,
+        random=False,
+        num_workers=NUM_DATALOADER_WORKERS,
+        pin_memory=torch.cuda.is_available())
+
+    features = None
+    start_index = 0
+    with torch.no_grad():
+        for inputs in data_loader:
+            move_inputs_to_device(inputs, device=model.device)
+            batch_features = compute_BERT_CLS_feature(
+                model, **inputs).cpu().numpy()
+            if features is None:
+                shape = (len(dataset), batch_features.shape[-1])
+                if file_name is None:
+                    features = np.empty(
+                        shape, dtype=CLS_FEATURES_CACHE_DTYPE)
+                else:
+                    # Written under a temporary name so that an interrupted
+                    # run does not leave a partially filled cache behind
+                    tmp_file_name = f"{file_name}.tmp.npy"
+                    features = np.lib.format.open_memmap(
+                        tmp_file_name,
+                        mode="w+",
+                        dtype=CLS_FEATURES_CACHE_DTYPE,
+                        shape=shape)
+
+            end_index = start_index + batch_features.shape[0]
+            features[start_index: end_index] = batch_features
+            start_index = end_index
+
+    if file_name is None:
+        return features
+
+    features.flush()
+    del features
+    os.replace(tmp_file_name, file_name)
+    return np.load(file_name, mmap_mode="r")
+
+
 def create_tokenizer_and_model(
     model_name_or_path: str, freeze_parameters: bool = True
 ) -> Tuple[BertTokenizer, BertForSequenceClassification]:
@@ -175,19 +311,36 @@ def create_datasets(
         task_name=task_name, data_dir=data_dir, max_seq_length=128
     )
 
+    # Shared across the splits
+    processor = data_utils.glue_processors[task_name]()
+    label_list = data_utils.get_label_list(
+        processor, task_name=task_name, tokenizer=tokenizer)
+
     train_dataset = CustomGlueDataset(
-        args=data_args, tokenizer=tokenizer, mode="train"
+        args=data_args,
+        tokenizer=tokenizer,
+        mode="train",
+        processor=processor,
+        label_list=label_list,
     )
 
     eval_dataset = CustomGlueDataset(
-        args=data_args, tokenizer=tokenizer, mode="dev"
+        args=data_args,
+        tokenizer=tokenizer,
+        mode="dev",
+        processor=processor,
+        label_list=label_list,
     )
 
     if create_test_dataset is False:
         return train_dataset, eval_dataset
     else:
         test_dataset = CustomGlueDataset(
-            args=data_args, tokenizer=tokenizer, mode="test"
+            args=data_args,
+            tokenizer=tokenizer,
+            mode="test",
+            processor=processor,
+            label_list=label_list,
         )
 
         return train_dataset, eval_dataset, test_dataset
@@ -209,7 +362,7 @@ def predict(
 
     for k, v in inputs.items():
         if isinstance(v, torch.Tensor):
-            inputs[k] = v.to(trainer.args.device)
+            inputs[k] = v.to(trainer.args.device, non_blocking=True)
 
     step_eval_loss = None
     with torch.no_grad():
@@ -238,7 +391,18 @@ def get_dataloader(
     batch_size: int,
     random: bool = False,
     data_collator: Optional[DataCollator] = None,
-) -> DataLoader:
+    num_workers: int = 0,
+    pin_memory: bool = False,
+    prefetch_factor: int = 4,
+    cuda_prefetch: bool = False,
+    device: Optional[torch.device] = None,
+) -> Union[DataLoader, "CUDAPrefetcher"]:
+    """Worker processes and pinned memory are opt-in, as some callers build
+    loaders over CUDA tensors or pass them to spawned processes. Pinned memory
+    only overlaps the host-to-device copies with compute when callers move
+    the batches with `non_blocking=True`, or when `cuda_prefetch` is set, in
+    which case batches are returned already on `device` (defaults to the
+    current CUDA device)."""
     if data_collator is None:
         data_collator = default_data_collator
 
@@ -247,16 +411,74 @@ def get_dataloader(
     else:
         sampler = SequentialSampler(dataset)
 
+    # These are only valid with worker processes,
+    # and were added to `DataLoader` in PyTorch 1.7
+    worker_kwargs = {}
+    if num_workers > 0 and TORCH_VERSION >= (1, 7):
+        worker_kwargs = {
+            "prefetch_factor": prefetch_factor,
+            "persistent_workers": True,
+        }
+
     data_loader = DataLoader(
         dataset,
         sampler=sampler,
         batch_size=batch_size,
         collate_fn=data_collator,
+        num_workers=num_workers,
+        pin_memory=pin_memory,
+        **worker_kwargs,
     )
 
+    if cuda_prefetch is True:
+        if device is None:
+            device = torch.device("cuda")
+        return CUDAPrefetcher(data_loader, device=device)
+
     return data_loader
 
 
+class CUDAPrefetcher(object):
+    """Wraps a `DataLoader` and copies batch `n + 1` to the device
+    on a side stream while batch `n` is being consumed."""
+
+    def __init__(self, data_loader: DataLoader, device: torch.device) -> None:
+        self.data_loader = data_loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self) -> int:
+        return len(self.data_loader)
+
+    def __iter__(self):
+        iterator = iter(self.data_loader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            # Tensors were allocated on `self.stream`, so tell the
+            # allocator not to reuse them before `current_stream` is done
+            for v in batch.values():
+                if isinstance(v, torch.Tensor):
+                    v.record_stream(current_stream)
+
+            next_batch = self._preload(iterator)
+            yield batch
+
+    def _preload(
+        self, iterator: Any
+    ) -> Optional[Dict[str, Union[torch.Tensor, Any]]]:
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            move_inputs_to_device(batch, device=self.device)
+        return batch
+
+
 def remove_file_if_exists(file_name: str) -> None:
     if os.path.exists(file_name):
         os.remove(file_name)
@@ -270,14 +492,25 @@ def is_prediction_correct(
     inputs: Dict[str, Union[torch.Tensor, Any]],
 ) -> bool:
 
-    preds, label_ids, step_eval_loss = predict(
-        trainer=trainer, model=model, inputs=inputs
-    )
+    if trainer.args.past_index >= 0:
+        raise ValueError
+
+    move_inputs_to_device(inputs, device=trainer.args.device)
+
+    # Same label shift as in `predict`, which also
+    # applies to `inputs` seen later by the callers
+    inputs["labels"] -= 1
+    with torch.no_grad():
+        # Leave out the labels so that the loss is not computed
+        logits = model(**{
+            k: v for k, v in inputs.items()
+            if k != "labels"})[0]
 
-    if preds.shape[0] != 1:
+    if logits.shape[0] != 1:
         raise ValueError("This function only works on instances.")
 
-    return bool((preds.argmax(axis=-1) == label_ids).all())
+    # A single device-to-host sync instead of copying the logits and labels
+    return bool((logits.argmax(dim=-1) == inputs["labels"]).all().item())
 
 
 def move_inputs_to_device(
@@ -285,4 +518,4 @@ def move_inputs_to_device(
 ) -> None:
     for k, v in inputs.items():
         if isinstance(v, torch.Tensor):
-            inputs[k] = v.to(device)
+            inputs[k] = v.to(device, non_blocking=True)
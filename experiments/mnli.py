@@ -187,7 +187,9 @@ def run_full_influence_functions(
     batch_train_data_loader = misc_utils.get_dataloader(
         mnli_train_dataset,
         batch_size=128,
-        random=True)
+        random=True,
+        num_workers=misc_utils.NUM_DATALOADER_WORKERS,
+        pin_memory=torch.cuda.is_available())
 
     instance_train_data_loader = misc_utils.get_dataloader(
         mnli_train_dataset,
@@ -6,6 +6,7 @@
 import os
 import sys
 import torch
+import pickle
 import tempfile
 import numpy as np
 import torch.distributed as dist
@@ -182,6 +183,8 @@ def compute_s_test_and_influence(
     # Save outputs, normally we do not need
     # need `s_test` and saving it takes extra time,
     # but sometimes we need it for diagnostics.
+    # The default protocol (2) is noticeably slower for
+    # the many small tensors in `train_inputs_collections`.
     if return_s_test is True:
         torch.save(
             {
@@ -190,6 +193,7 @@ def compute_s_test_and_influence(
                 "s_test": s_test,
             },
             file_name,
+            pickle_protocol=pickle.HIGHEST_PROTOCOL,
         )
 
     else:
@@ -199,6 +203,7 @@ def compute_s_test_and_influence(
                 "train_inputs_collections": train_inputs_collections,
             },
             file_name,
+            pickle_protocol=pickle.HIGHEST_PROTOCOL,
         )
 
     # Always return both, though in multiprocessing